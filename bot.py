@@ -2,6 +2,13 @@
 import nonebot
 from nonebot.adapters.onebot.v11 import Adapter
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    # uvloop is unavailable on Windows; fall back to the default policy
+    pass
+
 nonebot.init()
 driver = nonebot.get_driver()
 driver.register_adapter(Adapter)
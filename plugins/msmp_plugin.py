@@ -1,10 +1,15 @@
 # plugins/msmp.py
-import asyncio, json, ssl
+import asyncio, io, itertools, json, mmap, os, random, ssl, time
 from typing import Any, Awaitable, Callable, Dict, List
-from nonebot import on_command, get_driver
+
+import ahocorasick
+import ijson
+import orjson
+import simdjson
+from nonebot import on_message, get_driver
 from nonebot.adapters.onebot.v11 import Bot, Event
 from websockets.client import connect
-from websockets.exceptions import ConnectionClosed
+from websockets.exceptions import ConnectionClosed, ConnectionClosedError
 
 import json
 from pathlib import Path
@@ -21,99 +26,214 @@ MSMP_SSL_PEM: str = getattr(cfg, "msmp_ssl_pem")
 # MSMP_ALLOWED_GROUPS=["123456789","987654321"]
 _allowed = getattr(cfg, "msmp_allowed_groups", [])
 ALLOWED_GROUPS = {int(x) for x in _allowed} if _allowed else set()
+# tuple snapshot for the broadcast loop; set iteration is slower and the
+# config never changes after load
+ALLOWED_GROUPS_T = tuple(ALLOWED_GROUPS)
 
 WHITELIST_LIMIT = 2
 USER_WHITELISTS: dict[str, set[str]] = {}
+# reverse index: whitelisted name -> user who claimed it, for O(1) duplicate checks
+NAME_TO_USER: dict[str, str] = {}
 
 DATA_FILE = Path(__file__).parent / "whitelist.json"
 
 sslctx = ssl.create_default_context(cafile=MSMP_SSL_PEM)
 sslctx.check_hostname = False  # self-signed / host mismatch
+# allow session tickets so reconnects can resume the TLS session
+# instead of paying a full handshake each time
+sslctx.options &= ~ssl.OP_NO_TICKET
 
 # msmp client
 Json = Dict[str, Any]
 NotifHandler = Callable[[Json], Awaitable[None]]
 
+# one reusable parser; simdjson only materializes the fields we touch
+PARSER = simdjson.Parser()
+# frames above this go through ijson so the DOM never materializes at once
+BIG_FRAME_BYTES = 64 * 1024
+
+def _as_py(v):
+    # containers come back as lazy proxies tied to PARSER's buffer,
+    # so convert them before the next frame is parsed
+    if isinstance(v, simdjson.Object):
+        return v.as_dict()
+    if isinstance(v, simdjson.Array):
+        return v.as_list()
+    return v
+
 class MSMPClient:
     def __init__(self, uri: str, secret: str, sslctx: ssl.SSLContext):
         self.uri, self.secret, self.sslctx = uri, secret, sslctx
+        # built once; every reconnect reuses the same context and headers
+        self._connect_kwargs = dict(
+            ssl=sslctx,
+            extra_headers={"Authorization": f"Bearer {secret}"},
+            ping_interval=20, ping_timeout=20,
+            open_timeout=5, close_timeout=2,
+        )
         self.ws = None
-        self._rid = 0
-        self._lock = asyncio.Lock()
+        # next(...) is atomic under the GIL, so id allocation needs no lock
+        self._rid = itertools.count(1)
         self._pending: Dict[int, asyncio.Future] = {}
         self._subs: Dict[str, List[NotifHandler]] = {}
+        # per-method request prefix, so param-less calls skip dict + full serialize
+        self._tmpl: Dict[str, bytes] = {}
         self._running = False
+        self._send_q: asyncio.Queue[tuple[int, bytes]] = asyncio.Queue()
         self._reader_task: asyncio.Task | None = None
+        self._writer_task: asyncio.Task | None = None
+        self._ready = asyncio.Event()
+        # bounds concurrent notification handlers so a flood (e.g. a server
+        # restart joining 100 players) can't overwhelm the OneBot gateway
+        self._notif_sem = asyncio.Semaphore(16)
 
     async def start(self):
         if self._running:
             return
         self._running = True
         self._reader_task = asyncio.create_task(self._run())
+        self._writer_task = asyncio.create_task(self._writer())
 
     async def stop(self):
         self._running = False
         if self.ws:
             await self.ws.close()
         if self._reader_task:
-            await self._reader_task
+            # cancel rather than await: the task may be mid-backoff-sleep,
+            # which would otherwise block shutdown for up to the backoff cap
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+        if self._writer_task:
+            self._writer_task.cancel()
 
     def on(self, notif_method: str, handler: NotifHandler):
         self._subs.setdefault(notif_method, []).append(handler)
 
     async def call(self, method: str, params: Json | None = None, timeout: float = 15.0):
         await self._wait_ready()
-        async with self._lock:
-            self._rid += 1
-            rid = self._rid
-            fut = asyncio.get_running_loop().create_future()
-            self._pending[rid] = fut
-            req: Json = {"jsonrpc": "2.0", "id": rid, "method": method}
-            if params is not None:  # include params only when provided
-                req["params"] = params
-            await self.ws.send(json.dumps(req))
+        rid = next(self._rid)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
+        if params is None:
+            tmpl = self._tmpl.get(method)
+            if tmpl is None:
+                tmpl = b'{"jsonrpc":"2.0","method":' + orjson.dumps(method) + b',"id":'
+                self._tmpl[method] = tmpl
+            payload = tmpl + str(rid).encode() + b"}"
+        else:
+            req: Json = {"jsonrpc": "2.0", "id": rid, "method": method, "params": params}
+            payload = orjson.dumps(req)
+        # hand the frame to the writer task; concurrent calls no longer wait
+        # for each other's send to finish
+        await self._send_q.put((rid, payload))
         return await asyncio.wait_for(fut, timeout=timeout)
 
     async def _wait_ready(self):
-        while not (self.ws and not self.ws.closed):
-            await asyncio.sleep(0.05)
+        await self._ready.wait()
+
+    async def _writer(self):
+        while self._running:
+            rid, payload = await self._send_q.get()
+            try:
+                await self._ready.wait()
+                if rid not in self._pending:
+                    continue  # caller already failed or timed out: drop the frame
+                await self.ws.send(payload)
+            except ConnectionClosed as e:
+                fut = self._pending.pop(rid, None)
+                if fut and not fut.done():
+                    fut.set_exception(e)
 
     async def _run(self):
+        backoff = 1.0
         while self._running:
             try:
-                async with connect(
-                    self.uri,
-                    ssl=self.sslctx,
-                    extra_headers={"Authorization": f"Bearer {self.secret}"},
-                    ping_interval=20, ping_timeout=20,
-                ) as ws:
+                async with connect(self.uri, **self._connect_kwargs) as ws:
                     self.ws = ws
+                    self._ready.set()
+                    backoff = 1.0  # connected: reset for the next outage
                     await self._recv_loop(ws)
             except Exception:
-                await asyncio.sleep(3.0)
+                # gate calls *before* sleeping, or they race onto the dead
+                # socket for the whole backoff window
+                self._ready.clear()
+                # exponential backoff with jitter, capped at 60s
+                await asyncio.sleep(min(backoff, 60.0) * (0.5 + random.random()))
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                self._ready.clear()
+
+    def _handle_frame(self, msg):
+        # msg is either a lazy simdjson Object or a plain dict (fallback);
+        # both support `in` and subscription
+        try:
+            rid = msg["id"]
+        except KeyError:
+            rid = None
+        if rid is not None:
+            fut = self._pending.pop(rid, None)
+            if fut is None or fut.done():
+                return  # stale or duplicate reply: never touch the body
+            try:
+                err = msg["error"]
+            except KeyError:
+                fut.set_result(_as_py(msg["result"]) if "result" in msg else None)
+            else:
+                fut.set_exception(RuntimeError(_as_py(err)))
+        else:
+            meth = msg["method"] if "method" in msg else ""
+            cbs = self._subs.get(meth, [])
+            if cbs:  # materialize params only when someone is subscribed
+                params = _as_py(msg["params"]) if "params" in msg else {}
+                for cb in cbs:
+                    asyncio.create_task(self._run_cb(cb, params))
+
+    async def _run_cb(self, cb: NotifHandler, params: Json):
+        async with self._notif_sem:
+            await cb(params)
+
+    def _handle_big_frame(self, data: bytes):
+        # oversized frames are in practice responses whose "result" is a big
+        # array (player roster, allowlist dump): locate the id, then stream
+        # the items instead of building the whole tree in one allocation
+        # use_float keeps numbers as floats, matching the simdjson/orjson
+        # path (ijson defaults to Decimal)
+        rid = next(ijson.items(io.BytesIO(data), "id", use_float=True), None)
+        if rid is None:  # big notification; no streaming shortcut for these
+            self._handle_frame(orjson.loads(data))
+            return
+        fut = self._pending.pop(rid, None)
+        if not fut or fut.done():
+            return  # nobody is waiting: skip parsing the body entirely
+        error = next(ijson.items(io.BytesIO(data), "error", use_float=True), None)
+        if error is not None:
+            fut.set_exception(RuntimeError(error))
+            return
+        result = list(ijson.items(io.BytesIO(data), "result.item", use_float=True))
+        if not result:  # result was not an array after all
+            result = next(ijson.items(io.BytesIO(data), "result", use_float=True), None)
+        fut.set_result(result)
 
     async def _recv_loop(self, ws):
         try:
             async for raw in ws:
-                msg = json.loads(raw)
-                if "id" in msg:
-                    fut = self._pending.pop(msg["id"], None)
-                    if fut and not fut.done():
-                        if "error" in msg:
-                            fut.set_exception(RuntimeError(msg["error"]))
-                        else:
-                            fut.set_result(msg.get("result"))
-                else:
-                    meth = msg.get("method", "")
-                    params = msg.get("params", {})
-                    for cb in self._subs.get(meth, []):
-                        asyncio.create_task(cb(params))
+                if len(raw) > BIG_FRAME_BYTES:
+                    self._handle_big_frame(raw.encode() if isinstance(raw, str) else raw)
+                    continue
+                try:
+                    self._handle_frame(PARSER.parse(raw))
+                except ValueError:
+                    self._handle_frame(orjson.loads(raw))
         except ConnectionClosed:
             pass
         finally:
             for fut in self._pending.values():
                 if not fut.done():
-                    fut.set_exception(ConnectionClosed(1006, "reconnecting"))
+                    # None/None/None = closed without a close frame (1006)
+                    fut.set_exception(ConnectionClosedError(None, None, None))
             self._pending.clear()
 
 msmp = MSMPClient(MSMP_URI, MSMP_SECRET, sslctx)
@@ -122,6 +242,7 @@ driver = get_driver()
 @driver.on_startup
 async def _startup():
     load_whitelist_data()
+    _build_automaton()
     await msmp.start()
     # await msmp.call("minecraft:notification/players/joined")
     # await msmp.call("minecraft:notification/players/left")
@@ -131,13 +252,16 @@ async def _startup():
 
 @driver.on_shutdown
 async def _shutdown():
-    save_whitelist_data()
+    if _save_task and not _save_task.done():
+        _save_task.cancel()
+    await save_whitelist_data()
     await msmp.stop()
 
 def load_whitelist_data() -> None:
-    global USER_WHITELISTS
+    global USER_WHITELISTS, NAME_TO_USER
     if not DATA_FILE.is_file():
         USER_WHITELISTS = {}
+        NAME_TO_USER = {}
         return
     with DATA_FILE.open("r", encoding="utf-8") as f:
         raw = json.load(f)
@@ -145,93 +269,169 @@ def load_whitelist_data() -> None:
     USER_WHITELISTS = {
         str(uid): set(names) for uid, names in raw.items() if isinstance(names, list)
     }
+    NAME_TO_USER = {n: uid for uid, names in USER_WHITELISTS.items() for n in names}
 
 
-def save_whitelist_data() -> None:
+def _sync_save() -> None:
     DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
-    raw = {uid: sorted(list(names)) for uid, names in USER_WHITELISTS.items()}
-    with DATA_FILE.open("w", encoding="utf-8") as f:
-        json.dump(raw, f, ensure_ascii=False, indent=2)
+    raw = {uid: sorted(names) for uid, names in USER_WHITELISTS.items()}
+    buf = orjson.dumps(raw, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    # write to a temp file and rename so a crash never truncates the data;
+    # pre-size and mmap it so the buffer lands in one copy
+    tmp = DATA_FILE.with_suffix(".tmp")
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+    try:
+        os.ftruncate(fd, len(buf))
+        try:
+            with mmap.mmap(fd, len(buf)) as mm:
+                mm[:] = buf
+                mm.flush()
+        except (ValueError, OSError):  # empty buffer or no mmap support
+            os.write(fd, buf)
+    finally:
+        os.close(fd)
+    os.replace(tmp, DATA_FILE)
+
+
+async def save_whitelist_data() -> None:
+    await asyncio.to_thread(_sync_save)
+
+
+SAVE_DEBOUNCE = 1.0
+_save_task: asyncio.Task | None = None
+
+def schedule_save() -> None:
+    # debounce: one disk write 1s after the last mutation, not one per command
+    global _save_task
+    if _save_task and not _save_task.done():
+        _save_task.cancel()
+    _save_task = asyncio.create_task(_delayed_save())
+
+async def _delayed_save() -> None:
+    await asyncio.sleep(SAVE_DEBOUNCE)
+    await save_whitelist_data()
 
 async def _broadcast_to_allowed(message: str):
-    if not ALLOWED_GROUPS:
+    if not ALLOWED_GROUPS_T:
         return
-    for bot in driver.bots.values():
-        for gid in ALLOWED_GROUPS:
-            try:
-                await bot.send_group_msg(group_id=gid, message=message)
-            except Exception:
-                pass
-            
+    bots = tuple(driver.bots.values())
+    tasks = [
+        bot.send_group_msg(group_id=gid, message=message)
+        for bot in bots
+        for gid in ALLOWED_GROUPS_T
+    ]
+    # one RTT total instead of one per group; failures are collected, not raised
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def _extract_names(params):
     names = []
-    if isinstance(params, dict):
-        if "player" in params and isinstance(params["player"], dict):
-            n = params["player"].get("name")
-            if n: names.append(n)
-        if "players" in params and isinstance(params["players"], list):
-            for p in params["players"]:
-                if isinstance(p, dict) and "name" in p:
-                    names.append(p["name"])
-    elif isinstance(params, list):
-        for p in params:
-            if isinstance(p, dict):
-                if "name" in p:
-                    names.append(p["name"])
-                elif "player" in p and isinstance(p["player"], dict) and "name" in p["player"]:
-                    names.append(p["player"]["name"])
-    elif isinstance(params, str):
-        names.append(params)
+    match params:
+        # type(p) is dict: parsed JSON only ever yields exact dicts, and the
+        # identity check is cheaper than isinstance on big player lists
+        case {"player": {"name": str(n)}, "players": [*ps]}:
+            names.append(n)
+            names += [p["name"] for p in ps if type(p) is dict and "name" in p]
+        case {"player": {"name": str(n)}}:
+            names.append(n)
+        case {"players": [*ps]}:
+            names += [p["name"] for p in ps if type(p) is dict and "name" in p]
+        case [*ps]:
+            for p in ps:
+                match p:
+                    case {"name": str(n)} | {"player": {"name": str(n)}}:
+                        names.append(n)
+        case str(s):
+            names.append(s)
     return names or ["Unknown"]
 
+# short TTL cache so /players bursts collapse into one RPC
+PLAYERS_TTL = 1.5
+_players_cache: list | None = None
+_players_cache_ts = 0.0
+
+def _invalidate_players_cache() -> None:
+    global _players_cache
+    _players_cache = None
+
 async def _on_join(params):
-    for name in _extract_names(params):
-        await _broadcast_to_allowed(f"【RPC】{name} 加入了游戏")
+    _invalidate_players_cache()
+    # coalesce batch notifications into one message per group
+    names = _extract_names(params)
+    await _broadcast_to_allowed(f"【RPC】{', '.join(names)} 加入了游戏")
 
 async def _on_left(params):
-    for name in _extract_names(params):
-        await _broadcast_to_allowed(f"【RPC】{name} 离开了游戏")
+    _invalidate_players_cache()
+    names = _extract_names(params)
+    await _broadcast_to_allowed(f"【RPC】{', '.join(names)} 离开了游戏")
     
     
 
-# /players command
-players_cmd = on_command("players", aliases={"在线玩家", "在线列表"})
-
-@players_cmd.handle()
+# command dispatch
+# one message handler with an Aho-Corasick automaton over every trigger,
+# instead of one matcher (and one rule check per message) per command
+_COMMAND_NAMES: dict[str, tuple[str, ...]] = {
+    "players": ("players", "在线玩家", "在线列表"),
+    "whitelist": ("whitelist", "白名单"),
+}
+AUTOMATON = ahocorasick.Automaton()
+
+def _build_automaton() -> None:
+    starts = set(getattr(driver.config, "command_start", None) or {"/"})
+    for key, names in _COMMAND_NAMES.items():
+        for name in names:
+            for start in starts:
+                trig = f"{start}{name}"
+                AUTOMATON.add_word(trig, (key, len(trig)))
+    AUTOMATON.make_automaton()
+
+msmp_cmd = on_message(priority=5)
+
+@msmp_cmd.handle()
 async def _(bot: Bot, event: Event):
+    text = event.get_plaintext().strip()
+    if not text:
+        return
+    for end, (key, trig_len) in AUTOMATON.iter(text):
+        if end + 1 != trig_len:  # trigger must sit at the start of the message
+            continue
+        if key == "players":
+            await _handle_players()
+        else:
+            await _handle_whitelist(str(event.user_id), text[trig_len:].strip())
+        return
+
+
+async def _handle_players() -> None:
+    global _players_cache, _players_cache_ts
     try:
-        players = await msmp.call("minecraft:players")
+        if _players_cache is not None and time.monotonic() - _players_cache_ts < PLAYERS_TTL:
+            players = _players_cache
+        else:
+            players = await msmp.call("minecraft:players")
+            _players_cache, _players_cache_ts = players, time.monotonic()
         names = [p.get("name") for p in (players or []) if isinstance(p, dict)]
         msg = f"在线玩家 ({len(names)}): " + (", ".join(names) if names else "无")
     except Exception as e:
         msg = f"查询失败: {e}"
-    await players_cmd.finish(msg)
-
+    await msmp_cmd.finish(msg)
 
-# /whitelist command
-whitelist_cmd = on_command("whitelist", aliases={"白名单"})
 
-@whitelist_cmd.handle()
-async def _(bot: Bot, event: Event):
-    text = event.get_plaintext().strip()
-    parts = text.split(maxsplit=1)
-
-    if len(parts) < 2:
-        await whitelist_cmd.finish("用法：/whitelist <玩家名>")
-
-    name = parts[1].strip()
+async def _handle_whitelist(user_id: str, name: str) -> None:
     if not name:
-        await whitelist_cmd.finish("用法：/whitelist <玩家名>")
+        await msmp_cmd.finish("用法：/whitelist <玩家名>")
 
-    user_id = str(event.user_id)
     used = USER_WHITELISTS.setdefault(user_id, set())
 
     if name in used:
-        await whitelist_cmd.finish(f"你已经为 {name} 申请过白名单了。")
+        await msmp_cmd.finish(f"你已经为 {name} 申请过白名单了。")
+
+    if name in NAME_TO_USER:
+        await msmp_cmd.finish(f"{name} 已被其他人申请过白名单了。")
 
     if len(used) >= WHITELIST_LIMIT:
         used_list = ", ".join(sorted(used))
-        await whitelist_cmd.finish(
+        await msmp_cmd.finish(
             f"你已经用完白名单名额（{WHITELIST_LIMIT} 个）：{used_list}"
         )
 
@@ -239,10 +439,11 @@ async def _(bot: Bot, event: Event):
     try:
         await msmp.call("minecraft:allowlist/add", {"add": [{"name": name}]})
     except Exception as e:
-        await whitelist_cmd.finish(f"添加白名单失败：{e}")
+        await msmp_cmd.finish(f"添加白名单失败：{e}")
 
 # add local record
     used.add(name)
-    save_whitelist_data()
+    NAME_TO_USER[name] = user_id
+    schedule_save()
 
-    await whitelist_cmd.finish(f"已为你添加白名单：{name}")
+    await msmp_cmd.finish(f"已为你添加白名单：{name}")